@@ -1,17 +1,84 @@
 #!/usr/bin/python3
 #
-# Defines base Service, Characteristic, Descriptor, Advertisement, Application and Agent classes 
+# Defines base Service, Characteristic, Descriptor, Advertisement, Application and Agent classes
+# with cached introspection
 
 import dbus
 import dbus.exceptions
 import dbus.service
 import bluetooth_constants
 import bluetooth_exceptions
+import _dbus_bindings
+from gi.repository import GLib
 import sys
 sys.path.insert(0, '.')
 
 
-class Service(dbus.service.Object):
+class IntrospectableObject(dbus.service.Object):
+    """
+    org.freedesktop.DBus.Introspectable implementation that caches its XML
+    """
+
+    # <interface> elements per class, they only depend on the method tables
+    _introspect_interfaces = {}
+
+    _introspect_path = None
+    _introspect_xml = None
+
+    @classmethod
+    def get_introspect_interfaces(cls):
+        xml = IntrospectableObject._introspect_interfaces.get(cls)
+        if xml is None:
+            parts = []
+            interfaces = cls._dbus_class_table[cls.__module__ + '.' + cls.__name__]
+            for (name, funcs) in interfaces.items():
+                parts.append('  <interface name="%s">\n' % name)
+                for func in funcs.values():
+                    if getattr(func, '_dbus_is_method', False):
+                        parts.append(cls._reflect_on_method(func))
+                    elif getattr(func, '_dbus_is_signal', False):
+                        parts.append(cls._reflect_on_signal(func))
+                parts.append('  </interface>\n')
+            xml = ''.join(parts)
+            IntrospectableObject._introspect_interfaces[cls] = xml
+        return xml
+
+    def get_child_paths(self):
+        return []
+
+    def get_child_nodes(self, object_path):
+        prefix = object_path.rstrip('/') + '/'
+        result = []
+        for path in self.get_child_paths():
+            if path.startswith(prefix):
+                name = path[len(prefix):].split('/', 1)[0]
+                if name not in result:
+                    result.append(name)
+        return result
+
+    def invalidate_introspection(self):
+        self._introspect_path = None
+        self._introspect_xml = None
+
+    @dbus.service.method(bluetooth_constants.DBUS_INTROSPECTABLE_INTERFACE,
+                         in_signature='',
+                         out_signature='s',
+                         path_keyword='object_path',
+                         connection_keyword='connection')
+    def Introspect(self, object_path, connection):
+        if self._introspect_xml is None or self._introspect_path != object_path:
+            parts = [_dbus_bindings.DBUS_INTROSPECT_1_0_XML_DOCTYPE_DECL_LINE]
+            parts.append('<node name="%s">\n' % object_path)
+            parts.append(self.get_introspect_interfaces())
+            for name in self.get_child_nodes(object_path):
+                parts.append('  <node name="%s"/>\n' % name)
+            parts.append('</node>\n')
+            self._introspect_xml = ''.join(parts)
+            self._introspect_path = object_path
+        return self._introspect_xml
+
+
+class Service(IntrospectableObject):
     """
     org.bluez.GattService1 interface implementation
     """
@@ -22,7 +89,7 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        IntrospectableObject.__init__(self, bus, self.path)
 
     def get_properties(self):
         return {
@@ -40,6 +107,7 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate_introspection()
 
     def get_characteristic_paths(self):
         result = []
@@ -50,6 +118,9 @@ class Service(dbus.service.Object):
     def get_characteristics(self):
         return self.characteristics
 
+    def get_child_paths(self):
+        return self.get_characteristic_paths()
+
     @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES_INTERFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -59,11 +130,71 @@ class Service(dbus.service.Object):
         return self.get_properties()[bluetooth_constants.BLUEZ_GATT_SERVICE_INTERFACE]
 
 
-class Characteristic(dbus.service.Object):
+class WriteBuffer(object):
+    """
+    Reassembly buffer for the offset (long or reliable) writes of one device
+    """
+
+    def __init__(self, size, max_size):
+        self.data = bytearray(size)
+        self.length = 0
+        self.max_size = max_size
+        self.pending = False
+        self.write_type = None
+        self.flush_source = None
+
+    def write(self, offset, value, write_type):
+        end = offset + len(value)
+        if offset > self.length:
+            raise bluetooth_exceptions.InvalidOffsetException()
+        if end > self.max_size:
+            raise bluetooth_exceptions.InvalidValueLengthException()
+        if end > len(self.data):
+            size = len(self.data) or 1
+            while size < end:
+                size *= 2
+            self.data.extend(bytes(min(size, self.max_size) - len(self.data)))
+        self.data[offset:end] = value
+        if offset == 0:
+            self.length = end
+        elif end > self.length:
+            self.length = end
+        self.pending = True
+        self.write_type = write_type
+
+    def take(self):
+        if self.flush_source is not None:
+            GLib.source_remove(self.flush_source)
+            self.flush_source = None
+        self.pending = False
+        with memoryview(self.data) as view:
+            value = bytes(view[:self.length])
+        self.length = 0
+        return value
+
+    def discard(self):
+        if self.flush_source is not None:
+            GLib.source_remove(self.flush_source)
+            self.flush_source = None
+        self.pending = False
+        self.length = 0
+
+
+class Characteristic(IntrospectableObject):
     """
     org.bluez.GattCharacteristic1 interface implementation
     """
 
+    # set to an emulator_capture.AttCapture to record GATT traffic
+    capture = None
+
+    # ATT attribute values are at most 512 bytes
+    write_buffer_size = 64
+    write_buffer_max_size = 512
+
+    # milliseconds after the last fragment before a long write is complete
+    long_write_timeout = 100
+
     def __init__(self, bus, index, uuid, flags, service):
         self.path = service.path + '/char' + str(index)
         self.bus = bus
@@ -71,7 +202,11 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.write_buffers = {}
+        self.notifying = False
+        # last device seen, for recording notifications and socket traffic
+        self.device = ''
+        IntrospectableObject.__init__(self, bus, self.path)
 
     def get_properties(self):
         return {
@@ -90,6 +225,7 @@ class Characteristic(dbus.service.Object):
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate_introspection()
 
     def get_descriptor_paths(self):
         result = []
@@ -100,21 +236,157 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
+    def get_child_paths(self):
+        return self.get_descriptor_paths()
+
     @dbus.service.method(bluetooth_constants.DBUS_PROPERTIES_INTERFACE, in_signature='s', out_signature='a{sv}')
     def GetAll(self, interface):
         if interface != bluetooth_constants.BLUEZ_GATT_CHARACTERISTIC_INTERFACE:
             raise bluetooth_exceptions.InvalidArgsException()
         return self.get_properties()[bluetooth_constants.BLUEZ_GATT_CHARACTERISTIC_INTERFACE]
 
+    def read_value(self, options):
+        print('Default ReadValue called, returning error')
+        raise bluetooth_exceptions.NotSupportedException()
+
     @dbus.service.method(bluetooth_constants.BLUEZ_GATT_CHARACTERISTIC_INTERFACE, in_signature='a{sv}', out_signature='ay')
     def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
+        offset = int(options.get('offset', 0))
+        if 'device' in options:
+            self.device = str(options['device'])
+        try:
+            value = self.read_value(options)
+        except dbus.exceptions.DBusException as e:
+            if self.capture is not None:
+                self.capture.read_error(self.device, self, offset, e)
+            raise
+        if offset:
+            value = value[offset:]
+        if self.capture is not None:
+            self.capture.read(self.device, self, value, offset)
+        return value
+
+    def get_write_buffer(self, device):
+        buffer = self.write_buffers.get(device)
+        if buffer is None:
+            buffer = WriteBuffer(self.write_buffer_size, self.write_buffer_max_size)
+            self.write_buffers[device] = buffer
+        return buffer
+
+    def assemble_write(self, value, device, write_type, offset, mtu):
+        """
+        Adds a write to the device's buffer, returns the value if complete
+
+        Write requests and commands at offset 0 are complete at once, as
+        BlueZ does not split them. BlueZ does not signal the end of a long
+        (offset or reliable) write, so it is complete when a fragment is
+        shorter than a prepare write payload (mtu - 5). A long write that is
+        an exact multiple of mtu - 5 is only completed by flush_write(),
+        long_write_timeout milliseconds after its last fragment, or earlier
+        if the next write from the device starts at offset 0.
+        """
+        buffer = self.get_write_buffer(device)
+        try:
+            buffer.write(offset, value, write_type)
+        except dbus.exceptions.DBusException:
+            # a rejected fragment fails the whole long write
+            buffer.discard()
+            raise
+        if offset == 0 and write_type in ('request', 'command'):
+            return buffer.take()
+        if mtu is None or len(value) < mtu - 5:
+            return buffer.take()
+        if buffer.flush_source is not None:
+            GLib.source_remove(buffer.flush_source)
+        buffer.flush_source = GLib.timeout_add(self.long_write_timeout, self.flush_write_timeout, device)
+        return None
+
+    def complete_long_write(self, value, device, write_type):
+        if self.capture is not None:
+            self.capture.execute_write(device)
+        try:
+            self.write_value_complete(value, device, write_type)
+        except dbus.exceptions.DBusException as e:
+            if self.capture is not None:
+                self.capture.execute_write_error(device, self, e)
+            raise
+        if self.capture is not None:
+            self.capture.execute_write_response(device)
+
+    def flush_write(self, device):
+        # completes a pending long write outside of its WriteValue calls, so
+        # errors are only logged
+        buffer = self.write_buffers.get(device)
+        if buffer is not None and buffer.pending:
+            write_type = buffer.write_type
+            try:
+                self.complete_long_write(buffer.take(), device, write_type)
+            except dbus.exceptions.DBusException as e:
+                print('WriteValue ' + write_type + ' failed: ' + str(e))
+
+    def flush_write_timeout(self, device):
+        # the source is removed by returning False, so take() must not remove it
+        buffer = self.write_buffers.get(device)
+        if buffer is not None:
+            buffer.flush_source = None
+        self.flush_write(device)
+        return False
+
+    def write_value_complete(self, value, device, write_type):
+        print('Default WriteValue called, returning error')
         raise bluetooth_exceptions.NotSupportedException()
 
     @dbus.service.method(bluetooth_constants.BLUEZ_GATT_CHARACTERISTIC_INTERFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
-        raise bluetooth_exceptions.NotSupportedException()
+        device = str(options.get('device', ''))
+        write_type = str(options.get('type', 'request'))
+        offset = int(options.get('offset', 0))
+        mtu = int(options['mtu']) if 'mtu' in options else None
+        self.device = device
+        long_write = offset != 0 or write_type == 'reliable'
+        if offset == 0:
+            # complete an earlier long write before this one is recorded
+            self.flush_write(device)
+        if self.capture is not None:
+            self.capture.write(device, self, value, write_type, offset)
+        try:
+            data = self.assemble_write(value, device, write_type, offset, mtu)
+        except dbus.exceptions.DBusException as e:
+            if self.capture is not None:
+                self.capture.write_error(device, self, write_type, offset, e)
+            # a write command has no response to carry the error
+            if write_type != 'command':
+                raise
+            print('WriteValue command failed: ' + str(e))
+            return
+        if long_write:
+            if self.capture is not None:
+                self.capture.write_response(device, self, value, write_type, offset)
+            if data is not None:
+                self.complete_long_write(data, device, write_type)
+            return
+        try:
+            self.write_value_complete(data, device, write_type)
+        except dbus.exceptions.DBusException as e:
+            if self.capture is not None:
+                self.capture.write_error(device, self, write_type, offset, e)
+            if write_type != 'command':
+                raise
+            print('WriteValue command failed: ' + str(e))
+            return
+        if self.capture is not None:
+            self.capture.write_response(device, self, value, write_type, offset)
+
+    def notify_value(self, value):
+        if not self.notifying:
+            return
+        if self.capture is not None:
+            self.capture.notify(self.device, self, value)
+        self.PropertiesChanged(bluetooth_constants.BLUEZ_GATT_CHARACTERISTIC_INTERFACE,
+                               {'Value': dbus.Array(value, signature='y')}, [])
+
+    def start_simulation(self, wheel):
+        pass
 
     @dbus.service.method(bluetooth_constants.BLUEZ_GATT_CHARACTERISTIC_INTERFACE)
     def StartNotify(self):
@@ -131,7 +403,7 @@ class Characteristic(dbus.service.Object):
         pass
 
 
-class Descriptor(dbus.service.Object):
+class Descriptor(IntrospectableObject):
     """
     org.bluez.GattDescriptor1 interface implementation
     """
@@ -142,7 +414,7 @@ class Descriptor(dbus.service.Object):
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
-        dbus.service.Object.__init__(self, bus, self.path)
+        IntrospectableObject.__init__(self, bus, self.path)
 
     def get_properties(self):
         return {
@@ -178,7 +450,7 @@ class Descriptor(dbus.service.Object):
         raise bluetooth_exceptions.NotSupportedException()
 
 
-class Advertisement(dbus.service.Object):
+class Advertisement(IntrospectableObject):
 
     def __init__(self, bus, path_base, index, advertising_type):
         self.path = path_base + '/advertisement' + str(index)
@@ -192,7 +464,7 @@ class Advertisement(dbus.service.Object):
         self.include_tx_power = False
         self.data = None
         self.discoverable = True
-        dbus.service.Object.__init__(self, bus, self.path)
+        IntrospectableObject.__init__(self, bus, self.path)
 
     def add_service_uuid(self, uuid):
         if not self.service_uuids:
@@ -268,7 +540,7 @@ class Advertisement(dbus.service.Object):
         print('%s: Released' % self.path)
 
 
-class Application(dbus.service.Object):
+class Application(IntrospectableObject):
     """
     org.bluez.GattApplication1 interface implementation
     """
@@ -276,13 +548,25 @@ class Application(dbus.service.Object):
     def __init__(self, bus):
         self.path = '/'
         self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        IntrospectableObject.__init__(self, bus, self.path)
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
         self.services.append(service)
+        self.invalidate_introspection()
+
+    def start_simulation(self, wheel):
+        for service in self.services:
+            for chrc in service.get_characteristics():
+                chrc.start_simulation(wheel)
+
+    def get_child_paths(self):
+        result = []
+        for service in self.services:
+            result.append(service.get_path())
+        return result
 
     @dbus.service.method(bluetooth_constants.DBUS_OBJECT_MANAGER_INTERFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
@@ -300,7 +584,7 @@ class Application(dbus.service.Object):
         return response
     
 
-class Agent(dbus.service.Object):
+class Agent(IntrospectableObject):
 
     @dbus.service.method(bluetooth_constants.BLUEZ_AGENT_INTERFACE, in_signature="", out_signature="")
     def Release(self):
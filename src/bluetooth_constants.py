@@ -2,6 +2,7 @@
 
 DBUS_PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
 DBUS_OBJECT_MANAGER_INTERFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_INTROSPECTABLE_INTERFACE = "org.freedesktop.DBus.Introspectable"
 
 BLUEZ_ADAPTER_NAME = "hci0"
 
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+#
+# Streaming capture of emulator GATT traffic as ATT PDUs in btsnoop or pcap
+# files, which can be opened in Wireshark or other Bluetooth analysis tools
+
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, '.')
+
+ATT_OP_ERROR_RSP = 0x01
+ATT_OP_READ_REQ = 0x0a
+ATT_OP_READ_RSP = 0x0b
+ATT_OP_READ_BLOB_REQ = 0x0c
+ATT_OP_READ_BLOB_RSP = 0x0d
+ATT_OP_WRITE_REQ = 0x12
+ATT_OP_WRITE_RSP = 0x13
+ATT_OP_PREPARE_WRITE_REQ = 0x16
+ATT_OP_PREPARE_WRITE_RSP = 0x17
+ATT_OP_EXECUTE_WRITE_REQ = 0x18
+ATT_OP_EXECUTE_WRITE_RSP = 0x19
+ATT_OP_HANDLE_VALUE_NTF = 0x1b
+ATT_OP_WRITE_CMD = 0x52
+
+ATT_EXECUTE_WRITE_COMMIT = 0x01
+
+ATT_ERROR_READ_NOT_PERMITTED = 0x02
+ATT_ERROR_WRITE_NOT_PERMITTED = 0x03
+ATT_ERROR_REQUEST_NOT_SUPPORTED = 0x06
+ATT_ERROR_INVALID_OFFSET = 0x07
+ATT_ERROR_INSUFFICIENT_AUTHORIZATION = 0x08
+ATT_ERROR_INVALID_VALUE_LENGTH = 0x0d
+ATT_ERROR_UNLIKELY = 0x0e
+
+# ATT error codes for the D-Bus errors in bluetooth_exceptions
+ATT_ERRORS = {
+    'org.bluez.Error.NotSupported': ATT_ERROR_REQUEST_NOT_SUPPORTED,
+    'org.bluez.Error.NotAuthorized': ATT_ERROR_INSUFFICIENT_AUTHORIZATION,
+    'org.bluez.Error.InvalidValueLength': ATT_ERROR_INVALID_VALUE_LENGTH,
+    'org.bluez.Error.InvalidOffset': ATT_ERROR_INVALID_OFFSET,
+}
+
+L2CAP_ATT_CID = 0x0004
+HCI_H4_ACL = 0x02
+HCI_ACL_START = 0x2000
+
+BTSNOOP_MAGIC = b'btsnoop\0'
+BTSNOOP_VERSION = 1
+BTSNOOP_DATALINK_H4 = 1002
+BTSNOOP_EPOCH_DELTA = 0x00dcddb30f2f8000
+
+# flush limits, so that a killed emulator loses little of its capture
+FLUSH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 1.0
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_LINKTYPE_H4_WITH_PHDR = 201
+
+
+class AttCapture(object):
+    """
+    Records GATT events as ATT PDUs. Callers only build the PDU and queue it;
+    a writer thread encodes, buffers and rotates the capture files, and
+    records are dropped (and counted) rather than blocking when it falls behind.
+    """
+
+    def __init__(self, path, file_format='btsnoop', max_size=16 * 1024 * 1024, backup_count=5, queue_size=10000):
+        if file_format not in ('btsnoop', 'pcap'):
+            raise ValueError('Unknown capture format: ' + file_format)
+        self.path = path
+        self.file_format = file_format
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.records = queue.Queue(queue_size)
+        self.dropped = 0
+        self.attribute_handles = {}
+        self.connection_handles = {}
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.unflushed = 0
+        self.flush_time = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='AttCapture', daemon=True)
+
+    def start(self):
+        # open here so that a bad path fails in the caller
+        self.open_file()
+        self.thread.start()
+        print('Capturing GATT traffic in %s format to %s' % (self.file_format, self.path))
+
+    def stop(self):
+        self.stopped = True
+        if self.thread.is_alive():
+            try:
+                self.records.put(None, timeout=5)
+            except queue.Full:
+                print('Capture writer is not responding')
+            self.thread.join(5)
+
+    def get_attribute_handle(self, chrc):
+        # BlueZ does not expose its attribute handles, so number the
+        # characteristics in the order they are first seen
+        with self.lock:
+            handle = self.attribute_handles.get(chrc.path)
+            if handle is None:
+                handle = len(self.attribute_handles) + 1
+                self.attribute_handles[chrc.path] = handle
+            return handle
+
+    def get_connection_handle(self, device):
+        with self.lock:
+            handle = self.connection_handles.get(device)
+            if handle is None:
+                handle = len(self.connection_handles) + 1
+                self.connection_handles[device] = handle
+            return handle
+
+    def record(self, device, received, pdu):
+        if self.stopped:
+            return
+        try:
+            self.records.put_nowait((time.time(), received, self.get_connection_handle(device), pdu))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def error(self, device, request_opcode, handle, error, reading):
+        code = ATT_ERRORS.get(error.get_dbus_name(), ATT_ERROR_UNLIKELY)
+        if error.get_dbus_name() == 'org.bluez.Error.NotPermitted':
+            code = ATT_ERROR_READ_NOT_PERMITTED if reading else ATT_ERROR_WRITE_NOT_PERMITTED
+        self.record(device, False, struct.pack('<BBHB', ATT_OP_ERROR_RSP, request_opcode, handle, code))
+
+    def read_request(self, device, chrc, offset):
+        handle = self.get_attribute_handle(chrc)
+        if offset:
+            self.record(device, True, struct.pack('<BHH', ATT_OP_READ_BLOB_REQ, handle, offset))
+        else:
+            self.record(device, True, struct.pack('<BH', ATT_OP_READ_REQ, handle))
+
+    def read(self, device, chrc, value, offset):
+        self.read_request(device, chrc, offset)
+        opcode = ATT_OP_READ_BLOB_RSP if offset else ATT_OP_READ_RSP
+        self.record(device, False, struct.pack('<B', opcode) + bytes(value))
+
+    def read_error(self, device, chrc, offset, error):
+        self.read_request(device, chrc, offset)
+        opcode = ATT_OP_READ_BLOB_REQ if offset else ATT_OP_READ_REQ
+        self.error(device, opcode, self.get_attribute_handle(chrc), error, True)
+
+    def is_prepare_write(self, write_type, offset):
+        return offset != 0 or write_type == 'reliable'
+
+    def write(self, device, chrc, value, write_type, offset):
+        handle = self.get_attribute_handle(chrc)
+        if self.is_prepare_write(write_type, offset):
+            pdu = struct.pack('<BHH', ATT_OP_PREPARE_WRITE_REQ, handle, offset)
+        elif write_type == 'command':
+            pdu = struct.pack('<BH', ATT_OP_WRITE_CMD, handle)
+        else:
+            pdu = struct.pack('<BH', ATT_OP_WRITE_REQ, handle)
+        self.record(device, True, pdu + bytes(value))
+
+    def write_response(self, device, chrc, value, write_type, offset):
+        # a prepare write response echoes the request, a write command has none
+        if self.is_prepare_write(write_type, offset):
+            handle = self.get_attribute_handle(chrc)
+            pdu = struct.pack('<BHH', ATT_OP_PREPARE_WRITE_RSP, handle, offset) + bytes(value)
+            self.record(device, False, pdu)
+        elif write_type != 'command':
+            self.record(device, False, struct.pack('<B', ATT_OP_WRITE_RSP))
+
+    def write_error(self, device, chrc, write_type, offset, error):
+        if self.is_prepare_write(write_type, offset):
+            opcode = ATT_OP_PREPARE_WRITE_REQ
+        elif write_type != 'command':
+            opcode = ATT_OP_WRITE_REQ
+        else:
+            return
+        self.error(device, opcode, self.get_attribute_handle(chrc), error, False)
+
+    def execute_write(self, device):
+        self.record(device, True, struct.pack('<BB', ATT_OP_EXECUTE_WRITE_REQ, ATT_EXECUTE_WRITE_COMMIT))
+
+    def execute_write_response(self, device):
+        self.record(device, False, struct.pack('<B', ATT_OP_EXECUTE_WRITE_RSP))
+
+    def execute_write_error(self, device, chrc, error):
+        self.error(device, ATT_OP_EXECUTE_WRITE_REQ, self.get_attribute_handle(chrc), error, False)
+
+    def notify(self, device, chrc, value):
+        handle = self.get_attribute_handle(chrc)
+        self.record(device, False, struct.pack('<BH', ATT_OP_HANDLE_VALUE_NTF, handle) + bytes(value))
+
+    def encode(self, timestamp, received, connection_handle, pdu):
+        l2cap = struct.pack('<HH', len(pdu), L2CAP_ATT_CID) + pdu
+        h4 = struct.pack('<BHH', HCI_H4_ACL, connection_handle | HCI_ACL_START, len(l2cap)) + l2cap
+        if self.file_format == 'btsnoop':
+            microseconds = int(timestamp * 1000000) + BTSNOOP_EPOCH_DELTA
+            header = struct.pack('>IIIIq', len(h4), len(h4), 1 if received else 0, self.dropped, microseconds)
+            return header + h4
+        seconds = int(timestamp)
+        data = struct.pack('>I', 1 if received else 0) + h4
+        header = struct.pack('<IIII', seconds, int((timestamp - seconds) * 1000000), len(data), len(data))
+        return header + data
+
+    def file_header(self):
+        if self.file_format == 'btsnoop':
+            return BTSNOOP_MAGIC + struct.pack('>II', BTSNOOP_VERSION, BTSNOOP_DATALINK_H4)
+        return struct.pack('<IHHiIII', PCAP_MAGIC, 2, 4, 0, 0, 65535, PCAP_LINKTYPE_H4_WITH_PHDR)
+
+    def open_file(self):
+        self.file = open(self.path, 'wb', buffering=FLUSH_SIZE * 2)
+        header = self.file_header()
+        self.file.write(header)
+        self.size = len(header)
+        self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+        self.flush_time = time.monotonic()
+
+    def rotate(self):
+        self.file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = '%s.%d' % (self.path, i)
+                if os.path.exists(source):
+                    os.replace(source, '%s.%d' % (self.path, i + 1))
+            os.replace(self.path, self.path + '.1')
+        self.open_file()
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self.records.get(timeout=FLUSH_INTERVAL)
+                except queue.Empty:
+                    # idle, so let the file catch up with the records so far
+                    if self.unflushed:
+                        self.flush()
+                    continue
+                if item is None:
+                    break
+                data = self.encode(*item)
+                if self.size + len(data) > self.max_size and self.size > len(self.file_header()):
+                    self.rotate()
+                self.file.write(data)
+                self.size += len(data)
+                self.unflushed += len(data)
+                if self.unflushed >= FLUSH_SIZE or time.monotonic() - self.flush_time >= FLUSH_INTERVAL:
+                    self.flush()
+        except OSError as e:
+            # stop recording, so that callers do not fill the queue for nothing
+            self.stopped = True
+            print('Capture to %s failed: %s' % (self.path, e))
+        finally:
+            try:
+                self.file.close()
+            except OSError:
+                pass
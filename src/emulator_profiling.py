@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+#
+# Profiling hooks for the emulator: thread stack dumps, tracemalloc snapshots
+# and a sampling profiler writing collapsed stacks for flame graphs
+
+import faulthandler
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+from gi.repository import GLib
+
+sys.path.insert(0, '.')
+
+
+def enable_stack_dump(signum=signal.SIGUSR1, file=sys.stderr):
+    # faulthandler dumps from a C level handler, so it works even while the
+    # GLib mainloop is stalled inside a callback
+    faulthandler.register(signum, file=file, all_threads=True)
+    print('Thread stacks are dumped on signal %d' % signum)
+
+
+def enable_tracemalloc_snapshots(path_base, signum=signal.SIGUSR2, frames=1):
+    tracemalloc.start(frames)
+    counter = [0]
+
+    def take_snapshot():
+        counter[0] += 1
+        path = '%s.%d.tracemalloc' % (path_base, counter[0])
+        tracemalloc.take_snapshot().dump(path)
+        print('tracemalloc snapshot written to ' + path)
+        return GLib.SOURCE_CONTINUE
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, take_snapshot)
+    print('tracemalloc snapshots are taken on signal %d' % signum)
+
+
+class StackSampler(object):
+    """
+    Periodically samples the stacks of all threads and writes them in
+    collapsed format (frame;frame;frame count), one line per distinct stack
+    """
+
+    def __init__(self, path, interval=0.01, write_interval=10.0):
+        if not interval > 0:
+            raise ValueError('Sampling interval must be greater than 0')
+        self.path = path
+        self.interval = interval
+        self.write_interval = write_interval
+        self.counts = {}
+        self.code_names = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='StackSampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print('Sampling stacks every %g s into %s' % (self.interval, self.path))
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(5)
+        self.write()
+
+    def frame_name(self, code):
+        name = self.code_names.get(code)
+        if name is None:
+            name = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            self.code_names[code] = name
+        return name
+
+    def sample(self):
+        own_ident = threading.get_ident()
+        thread_names = {}
+        for thread in threading.enumerate():
+            thread_names[thread.ident] = thread.name
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            key = (thread_names.get(ident, str(ident)), tuple(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self):
+        lines = []
+        for (thread_name, stack), count in self.counts.items():
+            names = [thread_name]
+            for code in reversed(stack):
+                names.append(self.frame_name(code))
+            lines.append(';'.join(names) + ' ' + str(count) + '\n')
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.writelines(lines)
+        os.replace(temp_path, self.path)
+
+    def run(self):
+        next_write = time.monotonic() + self.write_interval
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= next_write:
+                self.write()
+                next_write = time.monotonic() + self.write_interval
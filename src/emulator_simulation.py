@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+#
+# Hierarchical timer wheel on the GLib mainloop, used to drive simulated
+# characteristic values and notifications from a single timeout source
+
+import sys
+import time
+
+from gi.repository import GLib
+
+sys.path.insert(0, '.')
+
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 4
+
+
+class Timer(object):
+    """
+    A one shot or periodic timer, interval is in ticks
+    """
+
+    def __init__(self, expires, interval, callback, args):
+        self.expires = expires
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel: WHEEL_LEVELS levels of WHEEL_SIZE slots, each
+    level spanning WHEEL_SIZE times the previous one. Adding and cancelling
+    timers is O(1), and each tick only visits one slot, so the cost does not
+    grow with the number of timers that are not due.
+    """
+
+    def __init__(self, tick=0.1):
+        if not tick >= 0.001:
+            raise ValueError('Timer wheel tick must be at least 0.001 seconds')
+        self.tick = tick
+        self.levels = [[[] for _ in range(WHEEL_SIZE)] for _ in range(WHEEL_LEVELS)]
+        self.overflow = []
+        self.current = 0
+        self.count = 0
+        self.source_id = None
+        self.start_time = None
+
+    def ticks(self, seconds):
+        return max(1, int(round(seconds / self.tick)))
+
+    def call_later(self, seconds, callback, *args):
+        return self.add_timer(Timer(self.current + self.ticks(seconds), 0, callback, args))
+
+    def call_every(self, seconds, callback, *args):
+        interval = self.ticks(seconds)
+        return self.add_timer(Timer(self.current + interval, interval, callback, args))
+
+    def add_timer(self, timer):
+        self.insert(timer)
+        self.count += 1
+        if self.source_id is None:
+            self.start_time = time.monotonic() - self.current * self.tick
+            self.source_id = GLib.timeout_add(int(self.tick * 1000), self.on_timeout)
+        return timer
+
+    def insert(self, timer):
+        delta = timer.expires - self.current
+        for level in range(WHEEL_LEVELS):
+            if delta < (1 << (WHEEL_BITS * (level + 1))):
+                slot = (timer.expires >> (WHEEL_BITS * level)) & WHEEL_MASK
+                self.levels[level][slot].append(timer)
+                return
+        self.overflow.append(timer)
+
+    def cascade(self, level):
+        # move the timers of the next slot of this level down the wheel
+        slot = (self.current >> (WHEEL_BITS * level)) & WHEEL_MASK
+        timers = self.levels[level][slot]
+        self.levels[level][slot] = []
+        for timer in timers:
+            self.insert(timer)
+        return slot
+
+    def advance(self):
+        self.current += 1
+        if self.current & WHEEL_MASK == 0:
+            level = 1
+            while level < WHEEL_LEVELS and self.cascade(level) == 0:
+                level += 1
+            if level == WHEEL_LEVELS and self.overflow:
+                timers = self.overflow
+                self.overflow = []
+                for timer in timers:
+                    self.insert(timer)
+
+        slot = self.current & WHEEL_MASK
+        timers = self.levels[0][slot]
+        self.levels[0][slot] = []
+        for timer in timers:
+            if timer.cancelled:
+                self.count -= 1
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print('Timer callback failed: ' + str(e))
+            if timer.interval and not timer.cancelled:
+                timer.expires = self.current + timer.interval
+                self.insert(timer)
+            else:
+                self.count -= 1
+
+    def on_timeout(self):
+        # catch up on ticks missed while the mainloop was busy
+        due = int((time.monotonic() - self.start_time) / self.tick)
+        while self.current < due and self.count > 0:
+            self.advance()
+        if self.count > 0:
+            return True
+        self.source_id = None
+        return False
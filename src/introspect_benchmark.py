@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# Benchmark of tree-wide D-Bus introspection, dbus-python default versus cached
+#
+# usage: introspect_benchmark.py [services] [characteristics] [rounds]
+
+import bluetooth_classes
+
+import dbus
+import dbus.service
+import dbus.mainloop.glib
+
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+BENCHMARK_BASE_PATH = '/whitebear/benchmark'
+
+
+def build_tree(bus, service_count, characteristic_count):
+    application = bluetooth_classes.Application(bus)
+    for i in range(service_count):
+        service = bluetooth_classes.Service(bus, BENCHMARK_BASE_PATH, i, '180a', True)
+        for j in range(characteristic_count):
+            chrc = bluetooth_classes.Characteristic(bus, j, '2a26', ['read'], service)
+            chrc.add_descriptor(bluetooth_classes.Descriptor(bus, 0, '2901', ['read'], chrc))
+            service.add_characteristic(chrc)
+        application.add_service(service)
+    return application
+
+
+def tree_objects(application):
+    result = [application]
+    for service in application.services:
+        result.append(service)
+        for chrc in service.get_characteristics():
+            result.append(chrc)
+            result.extend(chrc.get_descriptors())
+    return result
+
+
+def time_introspection(objects, bus, rounds, introspect):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for obj in objects:
+            introspect(obj, obj.path, bus)
+    return time.perf_counter() - start
+
+
+service_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+characteristic_count = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+bus = dbus.SessionBus()
+
+objects = tree_objects(build_tree(bus, service_count, characteristic_count))
+
+for obj in objects:
+    default_xml = dbus.service.Object.Introspect(obj, obj.path, bus)
+    cached_xml = obj.Introspect(obj.path, bus)
+    if sorted(default_xml.splitlines()) != sorted(cached_xml.splitlines()):
+        print('Error: cached introspection differs for ' + obj.path)
+        sys.exit(1)
+
+default_time = time_introspection(objects, bus, rounds, dbus.service.Object.Introspect)
+cached_time = time_introspection(objects, bus, rounds, bluetooth_classes.IntrospectableObject.Introspect)
+
+calls = rounds * len(objects)
+print('objects: %d, rounds: %d' % (len(objects), rounds))
+print('default: %.3f s (%.1f us per call)' % (default_time, default_time * 1e6 / calls))
+print('cached:  %.3f s (%.1f us per call)' % (cached_time, cached_time * 1e6 / calls))
+print('speedup: %.1fx' % (default_time / cached_time))
@@ -6,6 +6,9 @@ import bluetooth_constants
 import bluetooth_classes
 import bluetooth_utils
 import bluetooth_exceptions
+import emulator_profiling
+import emulator_simulation
+import emulator_capture
 
 import dbus
 import dbus.exceptions
@@ -16,6 +19,9 @@ import sys
 import socket
 import os
 import threading
+import signal
+import argparse
+import cProfile
 
 from gi.repository import GObject
 from gi.repository import GLib
@@ -44,7 +50,14 @@ BATTERY_LEVEL_CHARACTERISTIC_UUID = '2a19'
 PEBBLE_REMOTE_BASE_PATH = '/whitebear/pebble'
 PEBBLE_AGENT_PATH = PEBBLE_REMOTE_BASE_PATH + '/agent'
 
+SIMULATED_BATTERY_DRAIN_SECONDS = 60
+SIMULATED_FIRMWARE_UPDATE_SECONDS = 600
+SIMULATED_FIRMWARE_VERSION = b"81"
+SIMULATED_PEBBLE_NOTIFY_SECONDS = 5
+SIMULATED_PEBBLE_NOTIFICATION = [0x00]
+
 pebble_application = None
+mainloop = None
 
 
 class PebbleAdvertisement(bluetooth_classes.Advertisement):
@@ -59,18 +72,44 @@ class PebbleAdvertisement(bluetooth_classes.Advertisement):
 
 class BatteryCharacteristic(bluetooth_classes.Characteristic):
 
-    def __init__(self, bus, index, service):
-        bluetooth_classes.Characteristic.__init__(self, bus, index, BATTERY_LEVEL_CHARACTERISTIC_UUID, ['read'], service)
+    def __init__(self, bus, index, service, simulate=False):
+        self.level = 88
+        # the real remote does not notify, so only simulated levels do
+        flags = ['read', 'notify'] if simulate else ['read']
+        bluetooth_classes.Characteristic.__init__(self, bus, index, BATTERY_LEVEL_CHARACTERISTIC_UUID, flags, service)
 
-    def ReadValue(self, options):
-        return dbus.Byte(88)
+    def read_value(self, options):
+        return bytes([self.level])
+
+    def StartNotify(self):
+        self.notifying = True
+
+    def StopNotify(self):
+        self.notifying = False
+
+    def drain(self):
+        # recharge when flat so that long simulations keep running
+        self.level = self.level - 1 if self.level > 0 else 100
+        self.notify_value([self.level])
+
+    def start_simulation(self, wheel):
+        wheel.call_every(SIMULATED_BATTERY_DRAIN_SECONDS, self.drain)
 
 
 class BatteryService(bluetooth_classes.Service):
 
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, simulate=False):
         bluetooth_classes.Service.__init__(self, bus, PEBBLE_REMOTE_BASE_PATH, index, BATTERY_LEVEL_SERVICE_UUID, True)
-        self.add_characteristic(BatteryCharacteristic(bus, 0, self))
+        self.add_characteristic(BatteryCharacteristic(bus, 0, self, simulate))
+
+
+class SimulationService(bluetooth_classes.Service):
+    # additional battery characteristics, to load the simulation with many values
+
+    def __init__(self, bus, index, count):
+        bluetooth_classes.Service.__init__(self, bus, PEBBLE_REMOTE_BASE_PATH, index, BATTERY_LEVEL_SERVICE_UUID, False)
+        for i in range(count):
+            self.add_characteristic(BatteryCharacteristic(bus, i, self, True))
 
 
 class UnknownCharacteristic(bluetooth_classes.Characteristic):
@@ -103,8 +142,8 @@ class PebbleCharacteristic(bluetooth_classes.Characteristic):
         
         self.socket_unlink()
 
-    def WriteValue(self, value, options):
-        print("WriteValue: " + bluetooth_utils.byteArrayToHexString(value))
+    def write_value_complete(self, value, device, write_type):
+        print("WriteValue (" + write_type + "): " + bluetooth_utils.byteArrayToHexString(value))
   
     def StartNotify(self):
         print("StartNotify")
@@ -114,6 +153,9 @@ class PebbleCharacteristic(bluetooth_classes.Characteristic):
         print("StopNotify")
         self.notifying = False
 
+    def start_simulation(self, wheel):
+        wheel.call_every(SIMULATED_PEBBLE_NOTIFY_SECONDS, self.notify_value, SIMULATED_PEBBLE_NOTIFICATION)
+
     def socket_process_data(self):
         print("socket processing data")    
 
@@ -123,9 +165,13 @@ class PebbleCharacteristic(bluetooth_classes.Characteristic):
                 break
             
             print("socket read: " + bluetooth_utils.byteArrayToHexString(read_data))
+            if self.capture is not None:
+                self.capture.write(self.device, self, read_data, 'command', 0)
             
             write_data = read_data[::-1]  # testing: reverse the bytes
             self.socket.send(write_data)
+            if self.capture is not None:
+                self.capture.notify(self.device, self, write_data)
             print("socket write: " + bluetooth_utils.byteArrayToHexString(write_data))
 
         self.socket.close()
@@ -142,6 +188,8 @@ class PebbleCharacteristic(bluetooth_classes.Characteristic):
     @dbus.service.method(bluetooth_constants.BLUEZ_GATT_CHARACTERISTIC_INTERFACE, in_signature='a{sv}')
     def AcquireWrite(self, options):
         print("AcquireWrite")
+        if 'device' in options:
+            self.device = str(options['device'])
         
         self.socket_unlink()
         
@@ -170,7 +218,7 @@ class ManufacturerCharacteristic(bluetooth_classes.Characteristic):
     def __init__(self, bus, index, service):
         bluetooth_classes.Characteristic.__init__(self, bus, index, DEVICE_INFO_MANUFACTURER_CHARACTERISTIC_UUID, ['read'], service)
 
-    def ReadValue(self, options):
+    def read_value(self, options):
         return b'Hunter Douglas'
 
 
@@ -179,7 +227,7 @@ class ModelNumberCharacteristic(bluetooth_classes.Characteristic):
     def __init__(self, bus, index, service):
         bluetooth_classes.Characteristic.__init__(self, bus, index, DEVICE_INFO_MODEL_NUMBER_CHARACTERISTIC_UUID, ['read'], service)
 
-    def ReadValue(self, options):
+    def read_value(self, options):
         return b"Pebble Remote"
 
 
@@ -188,17 +236,25 @@ class SerialNumberCharacteristic(bluetooth_classes.Characteristic):
     def __init__(self, bus, index, service):
         bluetooth_classes.Characteristic.__init__(self, bus, index, DEVICE_INFO_SERIAL_NUMBER_CHARACTERISTIC_UUID, ['read'], service)
 
-    def ReadValue(self, options):
+    def read_value(self, options):
         return b"9999"
 
 
 class FirmwareVersionCharacteristic(bluetooth_classes.Characteristic):
 
     def __init__(self, bus, index, service):
+        self.version = b"80"
         bluetooth_classes.Characteristic.__init__(self, bus, index, DEVICE_INFO_FIRMWARE_VERSION_CHARACTERISTIC_UUID, ['read'], service)
 
-    def ReadValue(self, options):
-        return b"80"
+    def read_value(self, options):
+        return self.version
+
+    def update_firmware(self, version):
+        print("Firmware updated to " + version.decode())
+        self.version = version
+
+    def start_simulation(self, wheel):
+        wheel.call_later(SIMULATED_FIRMWARE_UPDATE_SECONDS, self.update_firmware, SIMULATED_FIRMWARE_VERSION)
 
 
 class HardwareVersionCharacteristic(bluetooth_classes.Characteristic):
@@ -206,7 +262,7 @@ class HardwareVersionCharacteristic(bluetooth_classes.Characteristic):
     def __init__(self, bus, index, service):
         bluetooth_classes.Characteristic.__init__(self, bus, index, DEVICE_INFO_HARDWARE_VERSION_CHARACTERISTIC_UUID, ['read'], service)
 
-    def ReadValue(self, options):
+    def read_value(self, options):
         return b"1234"
 
 
@@ -215,7 +271,7 @@ class SoftwareVersionCharacteristic(bluetooth_classes.Characteristic):
     def __init__(self, bus, index, service):
         bluetooth_classes.Characteristic.__init__(self, bus, index, DEVICE_INFO_SOFTWARE_VERSION_CHARACTERISTIC_UUID, ['read'], service)
 
-    def ReadValue(self, options):
+    def read_value(self, options):
         return b"80"
 
 
@@ -233,12 +289,14 @@ class DeviceInformationService(bluetooth_classes.Service):
 
 class PebbleApplication(bluetooth_classes.Application):
 
-    def __init__(self, bus):
+    def __init__(self, bus, simulate=False, simulated_characteristics=0):
         bluetooth_classes.Application.__init__(self, bus)
         self.add_service(DeviceInformationService(bus, 0))
         self.add_service(UnknownService(bus, 2))
         self.add_service(PebbleService(bus, 1))
-        self.add_service(BatteryService(bus, 3))
+        self.add_service(BatteryService(bus, 3, simulate))
+        if simulate and simulated_characteristics > 0:
+            self.add_service(SimulationService(bus, 4, simulated_characteristics))
 
 
 def register_ad_cb():
@@ -259,35 +317,145 @@ def register_app_error_cb(error):
     mainloop.quit()
 
 
-dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-bus = dbus.SystemBus()
-
-bluez_path = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, bluetooth_constants.BLUEZ_NAMESPACE)
-agent_manager = dbus.Interface(bluez_path, bluetooth_constants.BLUEZ_AGENT_MANAGER_INTERFACE)
+def positive_float(text):
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError('must be greater than 0')
+    return value
 
-adapter_path = bluetooth_constants.BLUEZ_NAMESPACE + '/' + bluetooth_constants.BLUEZ_ADAPTER_NAME
-bluetooth_adapter = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_path)
 
-advertising_manager = dbus.Interface(bluetooth_adapter, bluetooth_constants.BLUEZ_ADVERTISING_MANAGER_INTERFACE)
-service_manager = dbus.Interface(bluetooth_adapter, bluetooth_constants.BLUEZ_GATT_MANAGER_INTERFACE)
-properties_manager = dbus.Interface(bluetooth_adapter, bluetooth_constants.DBUS_PROPERTIES_INTERFACE)
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return value
 
-pebble_advertisement = PebbleAdvertisement(bus, 0, 'peripheral')
-pebble_application = PebbleApplication(bus)
-pebble_agent = bluetooth_classes.Agent(bus, PEBBLE_AGENT_PATH)
-
-properties_manager.Set(bluetooth_constants.BLUEZ_ADAPTER_INTERFACE, "Powered", dbus.Boolean(0))
-properties_manager.Set(bluetooth_constants.BLUEZ_ADAPTER_INTERFACE, "Alias", dbus.String('PR:9999'))
-properties_manager.Set(bluetooth_constants.BLUEZ_ADAPTER_INTERFACE, "Powered", dbus.Boolean(1))
-
-mainloop = GLib.MainLoop()
-
-agent_manager.RegisterAgent(PEBBLE_AGENT_PATH, "NoInputNoOutput")
-advertising_manager.RegisterAdvertisement(pebble_advertisement.get_path(), {}, reply_handler=register_ad_cb, error_handler=register_ad_error_cb)
-service_manager.RegisterApplication(pebble_application.get_path(), {}, reply_handler=register_app_cb, error_handler=register_app_error_cb)
-
-agent_manager.RequestDefaultAgent(PEBBLE_AGENT_PATH)
-print('Pebble agent registered')
-
-mainloop.run()
 
+def terminate_cb():
+    # stop the mainloop so that main() stops the capture and sampler
+    print('Terminated')
+    mainloop.quit()
+    return GLib.SOURCE_REMOVE
+
+
+def simulation_tick(text):
+    # GLib timeouts have millisecond resolution, and 0 ms would be a busy loop
+    tick = float(text)
+    if not tick >= 0.001:
+        raise argparse.ArgumentTypeError('must be at least 0.001 seconds')
+    return tick
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Emulator for Hunter Douglas Pebble Remote')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='run the mainloop under cProfile and write the stats to FILE on exit')
+    parser.add_argument('--tracemalloc', metavar='PATH',
+                        help='trace allocations and write a snapshot to PATH.N.tracemalloc on SIGUSR2')
+    parser.add_argument('--tracemalloc-frames', metavar='N', type=positive_int, default=1,
+                        help='number of frames to keep per allocation traceback (default 1)')
+    parser.add_argument('--stack-dump', action='store_true',
+                        help='dump the stacks of all threads to stderr on SIGUSR1')
+    parser.add_argument('--sample', metavar='FILE',
+                        help='periodically sample all thread stacks and write them to FILE as collapsed stacks')
+    parser.add_argument('--sample-interval', metavar='SECONDS', type=positive_float, default=0.01,
+                        help='stack sampling interval (default 0.01)')
+    parser.add_argument('--simulate', action='store_true',
+                        help='simulate battery drain, firmware updates and periodic Pebble notifications')
+    parser.add_argument('--simulation-tick', metavar='SECONDS', type=simulation_tick, default=0.1,
+                        help='resolution of the simulation timer wheel, at least 0.001 (default 0.1)')
+    parser.add_argument('--simulated-characteristics', metavar='N', type=int, default=0,
+                        help='with --simulate, add a service with N simulated battery characteristics (default 0)')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='write GATT reads, writes and notifications as ATT packets to FILE')
+    parser.add_argument('--capture-format', choices=['btsnoop', 'pcap'], default='btsnoop',
+                        help='capture file format (default btsnoop)')
+    parser.add_argument('--capture-max-size', metavar='MB', type=int, default=16,
+                        help='rotate the capture file when it reaches this size (default 16)')
+    parser.add_argument('--capture-backups', metavar='N', type=int, default=5,
+                        help='number of rotated capture files to keep (default 5)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    global mainloop
+    global pebble_application
+
+    args = parse_args(argv)
+
+    if args.stack_dump:
+        emulator_profiling.enable_stack_dump()
+    if args.tracemalloc:
+        emulator_profiling.enable_tracemalloc_snapshots(args.tracemalloc, frames=args.tracemalloc_frames)
+
+    sampler = None
+    if args.sample:
+        sampler = emulator_profiling.StackSampler(args.sample, args.sample_interval)
+        sampler.start()
+
+    capture = None
+    try:
+        if args.capture:
+            capture = emulator_capture.AttCapture(args.capture, args.capture_format,
+                                                  args.capture_max_size * 1024 * 1024, args.capture_backups)
+            try:
+                capture.start()
+            except OSError as e:
+                print('Error: cannot write capture file: ' + str(e))
+                sys.exit(1)
+            bluetooth_classes.Characteristic.capture = capture
+
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        bus = dbus.SystemBus()
+
+        bluez_path = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, bluetooth_constants.BLUEZ_NAMESPACE)
+        agent_manager = dbus.Interface(bluez_path, bluetooth_constants.BLUEZ_AGENT_MANAGER_INTERFACE)
+
+        adapter_path = bluetooth_constants.BLUEZ_NAMESPACE + '/' + bluetooth_constants.BLUEZ_ADAPTER_NAME
+        bluetooth_adapter = bus.get_object(bluetooth_constants.BLUEZ_SERVICE_NAME, adapter_path)
+
+        advertising_manager = dbus.Interface(bluetooth_adapter, bluetooth_constants.BLUEZ_ADVERTISING_MANAGER_INTERFACE)
+        service_manager = dbus.Interface(bluetooth_adapter, bluetooth_constants.BLUEZ_GATT_MANAGER_INTERFACE)
+        properties_manager = dbus.Interface(bluetooth_adapter, bluetooth_constants.DBUS_PROPERTIES_INTERFACE)
+
+        pebble_advertisement = PebbleAdvertisement(bus, 0, 'peripheral')
+        pebble_application = PebbleApplication(bus, args.simulate, args.simulated_characteristics)
+        pebble_agent = bluetooth_classes.Agent(bus, PEBBLE_AGENT_PATH)
+
+        properties_manager.Set(bluetooth_constants.BLUEZ_ADAPTER_INTERFACE, "Powered", dbus.Boolean(0))
+        properties_manager.Set(bluetooth_constants.BLUEZ_ADAPTER_INTERFACE, "Alias", dbus.String('PR:9999'))
+        properties_manager.Set(bluetooth_constants.BLUEZ_ADAPTER_INTERFACE, "Powered", dbus.Boolean(1))
+
+        mainloop = GLib.MainLoop()
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, terminate_cb)
+
+        if args.simulate:
+            pebble_application.start_simulation(emulator_simulation.TimerWheel(args.simulation_tick))
+
+        agent_manager.RegisterAgent(PEBBLE_AGENT_PATH, "NoInputNoOutput")
+        advertising_manager.RegisterAdvertisement(pebble_advertisement.get_path(), {}, reply_handler=register_ad_cb, error_handler=register_ad_error_cb)
+        service_manager.RegisterApplication(pebble_application.get_path(), {}, reply_handler=register_app_cb, error_handler=register_app_error_cb)
+
+        agent_manager.RequestDefaultAgent(PEBBLE_AGENT_PATH)
+        print('Pebble agent registered')
+
+        if args.profile:
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(mainloop.run)
+            finally:
+                profile.dump_stats(args.profile)
+                print('cProfile stats written to ' + args.profile)
+        else:
+            mainloop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if capture is not None:
+            capture.stop()
+
+
+if __name__ == '__main__':
+    main()